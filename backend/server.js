@@ -93,13 +93,13 @@ app.post("/api/login", async (req, res) => {
 
 // === API Query vers Python ===
 app.post("/api/query", (req, res) => {
-  const { question, history = [] } = req.body;
+  const { question, history = [], conversation_id = "" } = req.body;
   if (!question) {
     return res.status(400).json({ error: "Question manquante" });
   }
 
   const scriptPath = path.join(__dirname, "..", "query_rag.py");
-  const python = spawn("python", [scriptPath, question, JSON.stringify(history)]);
+  const python = spawn("python", [scriptPath, question, JSON.stringify(history), String(conversation_id)]);
 
   let output = "";
   let errorOutput = "";
@@ -134,6 +134,74 @@ app.post("/api/query", (req, res) => {
 // === Servir les fichiers PDF ===
 app.use("/static/rapports", express.static(path.join(__dirname, "..", "modele_rag", "pdfs")));
 
+// === Daemon d'ingestion (python main.py --watch) ===
+const INGEST_DAEMON_URL = process.env.INGEST_DAEMON_URL || "http://127.0.0.1:5055";
+
+// Sans daemon (connexion refusée), on retombe sur une exécution de main.py
+function runIngestion(pdfName, res, successMessage) {
+  fetch(`${INGEST_DAEMON_URL}/ingest`, {
+    method: "POST",
+    headers: { "Content-Type": "application/json" },
+    body: JSON.stringify({ file: pdfName }),
+  })
+    .then(async (response) => {
+      let data;
+      try {
+        data = await response.json();
+      } catch (err) {
+        data = {};
+      }
+      if (!response.ok || data.job_id === undefined) {
+        return res.status(502).json({ error: "Réponse invalide du daemon d'ingestion.", details: data });
+      }
+      res.status(202).json({ message: "PDF reçu, ingestion en file d'attente.", job_id: data.job_id });
+    })
+    .catch((err) => {
+      // Ne pas lancer main.py en parallèle d'un daemon actif mais lent ou en erreur
+      if (err.cause?.code !== "ECONNREFUSED") {
+        console.error("Erreur daemon d'ingestion:", err);
+        return res.status(502).json({ error: "Daemon d'ingestion indisponible.", details: String(err.cause || err) });
+      }
+
+      console.log("Daemon d'ingestion injoignable, exécution directe de main.py");
+      const scriptPath = path.join(__dirname, "..", "main.py");
+      exec(`python "${scriptPath}"`, (error, stdout, stderr) => {
+        if (error) {
+          console.error("Erreur exec Python:", error);
+          console.error("STDERR:", stderr);
+          console.error("STDOUT:", stdout);
+          return res.status(500).json({
+            error: "Erreur lors du traitement Python.",
+            details: stderr.toString(),
+            output: stdout.toString(),
+          });
+        }
+
+        console.log("Traitement terminé:", stdout);
+        res.json({ message: successMessage });
+      });
+    });
+}
+
+// === Statut du daemon d'ingestion ===
+app.get("/api/ingest-status", async (req, res) => {
+  try {
+    const response = await fetch(`${INGEST_DAEMON_URL}/status`);
+    res.json(await response.json());
+  } catch (err) {
+    res.status(503).json({ error: "Daemon d'ingestion injoignable." });
+  }
+});
+
+app.get("/api/ingest-jobs/:id", async (req, res) => {
+  try {
+    const response = await fetch(`${INGEST_DAEMON_URL}/jobs/${encodeURIComponent(req.params.id)}`);
+    res.status(response.status).json(await response.json());
+  } catch (err) {
+    res.status(503).json({ error: "Daemon d'ingestion injoignable." });
+  }
+});
+
 // === Téléversement de fichiers PDF ===
 app.post("/api/upload-pdf", upload.single("pdf"), async (req, res) => {
   if (!req.file) return res.status(400).json({ error: "Aucun fichier envoyé." });
@@ -142,7 +210,6 @@ app.post("/api/upload-pdf", upload.single("pdf"), async (req, res) => {
   const tempPath = req.file.path;
   const finalPdfDir = path.join(__dirname, "..", "modele_rag", "pdfs");
   const targetPath = path.join(finalPdfDir, originalName);
-  const scriptPath = path.join(__dirname, "..", "main.py");
 
   // Crée le dossier PDF s’il n’existe pas
   if (!fsSync.existsSync(finalPdfDir)) {
@@ -152,42 +219,13 @@ app.post("/api/upload-pdf", upload.single("pdf"), async (req, res) => {
   // Fichier existe déjà ? => retraitement uniquement
   if (fsSync.existsSync(targetPath)) {
     console.log("Fichier déjà présent, on le traite à nouveau.");
-    exec(`python "${scriptPath}"`, (error, stdout, stderr) => {
-      if (error) {
-        console.error("Erreur exec Python:", error);
-        console.error("STDERR:", stderr);
-        return res.status(500).json({
-          error: "Erreur lors du traitement Python (fichier déjà existant).",
-          details: stderr.toString(),
-          output: stdout.toString(),
-        });
-      }
-
-      console.log("Traitement terminé:", stdout);
-      return res.json({ message: "PDF déjà existant mais retraité avec succès." });
-    });
-    return;
+    return runIngestion(originalName, res, "PDF déjà existant mais retraité avec succès.");
   }
 
   // Déplacement du fichier et traitement
   try {
     await fs.rename(tempPath, targetPath);
-
-    exec(`python "${scriptPath}"`, (error, stdout, stderr) => {
-      if (error) {
-        console.error("Erreur exec Python:", error);
-        console.error("STDERR:", stderr);
-        console.error("STDOUT:", stdout);
-        return res.status(500).json({
-          error: "Erreur lors du traitement Python.",
-          details: stderr.toString(),
-          output: stdout.toString(),
-        });
-      }
-
-      console.log("Traitement terminé:", stdout);
-      res.json({ message: "PDF ajouté et traité avec succès." });
-    });
+    runIngestion(originalName, res, "PDF ajouté et traité avec succès.");
   } catch (err) {
     console.error("Erreur déplacement fichier:", err);
     res.status(500).json({ error: "Erreur de déplacement du fichier." });
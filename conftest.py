@@ -0,0 +1 @@
+# Permet aux tests d'importer les modules à la racine du dépôt
@@ -1,14 +1,22 @@
 import os
 import json
-import hashlib
+import uuid
 from pymongo import MongoClient
 import gridfs
 from qdrant_client import QdrantClient
-from qdrant_client.models import VectorParams, Distance, PointStruct
+from qdrant_client.models import (
+    VectorParams, Distance, PointStruct, PayloadSchemaType,
+    Filter, FieldCondition, MatchAny, FilterSelector
+)
 from sentence_transformers import SentenceTransformer
 from modele_rag.extractor import extract_pdf_content
 from modele_rag.chunker import flatten_content
 from modele_rag.extract_tables_to_json import extract_tables_from_reports
+from modele_rag.ingest_daemon import (
+    HASH_ALGO, compute_hashes, load_stat_cache, save_stat_cache,
+    hash_matches_legacy_md5, run_daemon
+)
+from query_rag import build_snapshot as build_query_snapshot, ensure_sessions_index
 import sys
 print("Script Python démarré", file=sys.stderr)
 
@@ -20,6 +28,9 @@ print("Contenu du dossier 'pdfs' :", os.listdir(pdf_dir))
 
 collection_name = "rag_chunks"
 
+# Cache (taille, mtime, inode) -> hash, voir modele_rag/ingest_daemon.py
+STAT_CACHE_PATH = os.path.join(BASE_DIR, "modele_rag", ".stat_cache.json")
+
 # === Connexion MongoDB ===
 client = MongoClient("mongodb://localhost:27017/")
 db = client["rag_db"]
@@ -37,18 +48,6 @@ qdrant = QdrantClient(
 # === Modèle d'encodage ===
 encoder = SentenceTransformer("all-MiniLM-L6-v2")
 
-def report_already_extracted(pdf_name, current_hash):
-    existing = knowledge_col.find_one({"rapport": pdf_name})
-    return existing and existing.get("file_hash") == current_hash
-
-def compute_file_hash(path, algo="md5"):
-    h = hashlib.new(algo)
-    with open(path, "rb") as f:
-        while chunk := f.read(8192):
-            h.update(chunk)
-    return h.hexdigest()
-
-
 def store_pdf_in_gridfs(pdf_path, pdf_name):
     with open(pdf_path, "rb") as f:
         # Supprimer ancienne version dans GridFS si existe
@@ -71,22 +70,126 @@ def validate_and_clean_report(report_data, pdf_name):
     return report_data
 
 
-def main():
+def point_id(rapport, position):
+    # Identifiant stable par rapport : permet de remplacer les points d'un seul rapport
+    return str(uuid.uuid5(uuid.NAMESPACE_URL, f"{rapport}#{position}"))
+
+
+def ensure_qdrant_collection():
+    if not qdrant.collection_exists(collection_name=collection_name):
+        qdrant.create_collection(
+            collection_name=collection_name,
+            vectors_config=VectorParams(size=384, distance=Distance.COSINE)
+        )
+    # Index sur "rapport" pour supprimer les points d'un rapport par filtre
+    qdrant.create_payload_index(
+        collection_name=collection_name,
+        field_name="rapport",
+        field_schema=PayloadSchemaType.KEYWORD
+    )
+
+
+def reindex_reports(rapports):
+    """
+    Remplace chunks et vecteurs Qdrant des rapports donnés uniquement.
+    Les rapports supprimés du dossier n'ont plus de document knowledge :
+    leurs chunks et points sont simplement retirés.
+    """
+    rapports = sorted(rapports)
+
+    print("Génération des chunks...")
+    knowledge = list(knowledge_col.find({"rapport": {"$in": rapports}}))
+    chunks = flatten_content(knowledge)
+
+    for chunk in chunks:
+        if not isinstance(chunk.get("content"), str):
+            chunk["content"] = json.dumps(chunk["content"], ensure_ascii=False)
+
+    chunks_col.delete_many({"rapport": {"$in": rapports}})
+    if chunks:
+        chunks_col.insert_many(chunks)
+    print(f"{len(chunks)} chunk(s) inséré(s) dans 'chunks' pour {len(rapports)} rapport(s)")
+
+    print("Mise à jour de la collection Qdrant...")
+    ensure_qdrant_collection()
+
+    points = []
+    positions = {}
+    contents = [chunk["content"] for chunk in chunks]
+    embeddings = encoder.encode(contents, batch_size=64).tolist() if contents else []
+    for chunk, embedding in zip(chunks, embeddings):
+        rapport = chunk.get("rapport", "")
+        position = positions.get(rapport, 0)
+        positions[rapport] = position + 1
+        points.append(PointStruct(
+            id=point_id(rapport, position),
+            vector=embedding,
+            payload={
+                "chunk_id": chunk.get("chunk_id", position),
+                "rapport": rapport,
+                "page": chunk.get("page", None),
+                "content": chunk["content"]
+            }
+        ))
+
+    # Les anciens points de ces rapports sont retirés juste avant l'insertion des nouveaux
+    qdrant.delete(
+        collection_name=collection_name,
+        points_selector=FilterSelector(filter=Filter(must=[
+            FieldCondition(key="rapport", match=MatchAny(any=rapports))
+        ]))
+    )
+
+    # Pour éviter timeout, insertion par batch (exemple batch=100)
+    BATCH_SIZE = 100
+    for start in range(0, len(points), BATCH_SIZE):
+        batch = points[start:start+BATCH_SIZE]
+        qdrant.upsert(collection_name=collection_name, points=batch)
+        print(f"Batch {start} à {start+len(batch)} inséré dans Qdrant.")
+
+    print(f"{len(points)} vecteurs insérés dans Qdrant")
+
+    print("\nAperçu des premiers chunks insérés dans Qdrant :")
+    for i, pt in enumerate(points[:10]):
+        print(f"\nChunk {i + 1}")
+        print(f"Rapport : {pt.payload['rapport']}")
+        print(f"Page : {pt.payload.get('page', '-')}")
+        print(f"Longueur contenu : {len(pt.payload['content'])} caractères")
+        print(f"Contenu :\n{pt.payload['content'][:500]}...")
+        print("-" * 60)
+
+
+def main(changed_files=None):
+    """
+    Ingestion incrémentale : seuls les rapports nouveaux, modifiés ou
+    supprimés sont réextraits et réindexés. changed_files restreint le
+    traitement aux fichiers signalés par le daemon ; None traite tout le dossier.
+    Retourne {nom du fichier: erreur} pour les PDF qui n'ont pas pu être traités.
+    """
     print("Démarrage du pipeline MongoDB + GridFS + Qdrant...")
+    ensure_sessions_index()
 
-    existing_docs = list(knowledge_col.find({}))
+    # Seuls le nom et le hash sont nécessaires pour la comparaison
+    existing_docs = list(knowledge_col.find({}, {"rapport": 1, "file_hash": 1, "_id": 0}))
     print(f"{len(existing_docs)} document(s) trouvés dans MongoDB")
 
     pdf_files = [f for f in os.listdir(pdf_dir) if f.endswith(".pdf")]
+    stat_cache = load_stat_cache(STAT_CACHE_PATH)
+    file_hashes = compute_hashes(pdf_dir, pdf_files, stat_cache)
+    save_stat_cache(STAT_CACHE_PATH, stat_cache)
     existing_names = {doc.get("rapport", "") for doc in existing_docs}
 
     # On crée un dict pour retrouver le hash stocké en base par fichier
     hash_in_db = {doc.get("rapport", ""): doc.get("file_hash", "") for doc in existing_docs}
 
-    updated = False
+    changed_reports = set()
+    failed = {}
 
     # Suppression des documents absents du dossier local
     missing_files = existing_names - set(pdf_files)
+    if changed_files is not None:
+        missing_files &= set(changed_files)
+        pdf_files = [f for f in pdf_files if f in changed_files]
     if missing_files:
         knowledge_col.delete_many({"rapport": {"$in": list(missing_files)}})
         for name in missing_files:
@@ -94,42 +197,40 @@ def main():
             if f:
                 fs.delete(f._id)
         print(f"{len(missing_files)} rapport(s) supprimé(s) car absents du dossier.")
-        updated = True
+        changed_reports |= missing_files
 
     for pdf_name in pdf_files:
         full_path = os.path.join(pdf_dir, pdf_name)
-        current_hash = compute_file_hash(full_path)
+        current_hash = file_hashes[pdf_name]
 
         # Vérifier si le fichier est déjà en base avec même hash
         if pdf_name in existing_names and hash_in_db.get(pdf_name, "") == current_hash:
             print(f"{pdf_name} déjà présent et inchangé, aucun traitement.")
             continue  # passer au suivant sans retraiter
 
+        # Migration md5 -> blake2b sans ré-extraction du PDF
+        if pdf_name in existing_names and hash_matches_legacy_md5(full_path, hash_in_db.get(pdf_name, "")):
+            knowledge_col.update_one({"rapport": pdf_name}, {"$set": {"file_hash": current_hash}})
+            print(f"{pdf_name} inchangé, hash migré vers {HASH_ALGO}.")
+            continue
+
         print(f"Traitement : {pdf_name}")
 
         try:
             store_pdf_in_gridfs(full_path, pdf_name)
-            if not report_already_extracted(pdf_name, current_hash):
-                report = extract_pdf_content(full_path)
-                report = validate_and_clean_report(report, pdf_name)
-                report["file_hash"] = current_hash
-                knowledge_col.delete_many({"rapport": pdf_name})
-                knowledge_col.insert_one(report)
-                updated = True
-            else:
-                print(f"{pdf_name} déjà traité, aucune mise à jour.")
-
+            report = extract_pdf_content(full_path)
             report = validate_and_clean_report(report, pdf_name)
             report["file_hash"] = current_hash  # stocker le hash dans le document
             knowledge_col.delete_many({"rapport": pdf_name})
             knowledge_col.insert_one(report)
-            updated = True
+            changed_reports.add(pdf_name)
         except Exception as e:
             print(f"Erreur pour {pdf_name} : {e}")
+            failed[pdf_name] = str(e)
 
-    if not updated:
+    if not changed_reports:
         print("Aucun fichier nouveau ou modifié. La base de connaissance est à jour.")
-        return
+        return failed
 
     print("Insertion des documents terminée dans MongoDB")
 
@@ -138,70 +239,33 @@ def main():
         mongo_uri="mongodb://localhost:27017/",
         db_name="rag_db",
         input_collection="knowledge",
-        output_collection="tables"
+        output_collection="tables",
+        rapports=sorted(changed_reports)
     )
+    # Snapshot des tableaux lu par query_rag.py, régénéré une fois la collection complète
+    build_query_snapshot()
 
-    print("Génération des chunks...")
-    full_knowledge = list(knowledge_col.find({}))
-    chunks = flatten_content(full_knowledge)
-
-    for chunk in chunks:
-        if not isinstance(chunk.get("content"), str):
-            chunk["content"] = json.dumps(chunk["content"], ensure_ascii=False)
-
-    chunks_col.delete_many({})
-    chunks_col.insert_many(chunks)
-    print(f"{len(chunks)} chunk(s) inséré(s) dans 'chunks'")
-
-    print("Nettoyage et recréation de la collection Qdrant...")
-    if qdrant.collection_exists(collection_name=collection_name):
-        qdrant.delete_collection(collection_name=collection_name)
-
-    qdrant.create_collection(
-        collection_name=collection_name,
-        vectors_config=VectorParams(size=384, distance=Distance.COSINE)
-    )
-
-    print("Insertion des vecteurs dans Qdrant...")
-    points = []
-    for i, chunk in enumerate(chunks):
-        try:
-            content = chunk["content"]
-            embedding = encoder.encode(content).tolist()
-            points.append(PointStruct(
-                id=i,
-                vector=embedding,
-                payload={
-                    "chunk_id": chunk.get("id", i),
-                    "rapport": chunk.get("rapport", ""),
-                    "page": chunk.get("page", None),
-                    "content": content
-                }
-            ))
-        except Exception as e:
-            print(f"Chunk {i} : échec d'encodage : {e}")
-
-    # Pour éviter timeout, insertion par batch (exemple batch=100)
-    BATCH_SIZE = 100
-    for start in range(0, len(points), BATCH_SIZE):
-        batch = points[start:start+BATCH_SIZE]
-        qdrant.upsert(collection_name=collection_name, points=batch)
-        print(f"Batch {start} à {start+len(batch)} inséré dans Qdrant.")
+    reindex_reports(changed_reports)
 
-    print(f"{len(points)} vecteurs insérés dans Qdrant")
-
-    print("\nAperçu des premiers chunks insérés dans Qdrant :")
-    for i, pt in enumerate(points[:10]):
-        print(f"\nChunk {i + 1}")
-        print(f"Rapport : {pt.payload['rapport']}")
-        print(f"Page : {pt.payload.get('page', '-')}")
-        print(f"Longueur contenu : {len(pt.payload['content'])} caractères")
-        print(f"Contenu :\n{pt.payload['content'][:500]}...")
-        print("-" * 60)
+    # Les sessions de conversation (query_rag.py) gardent en cache des points
+    # de ces rapports : leurs ids et contenus ne sont plus valides
+    sessions = db["sessions"].delete_many({"$or": [
+        {"candidates.payload.rapport": {"$in": list(changed_reports)}},
+        {"table_keys.rapport": {"$in": list(changed_reports)}},
+    ]})
+    print(f"{sessions.deleted_count} session(s) de conversation invalidée(s)")
+    return failed
 
 
 if __name__ == "__main__":
+    if "--watch" in sys.argv:
+        run_daemon(pdf_dir, main)
+        sys.exit(0)
     try:
-        main()
+        failed = main()
     except Exception as e:
         print(f"Erreur fatale : {e}")
+    else:
+        if failed:
+            print(f"{len(failed)} fichier(s) en échec : {', '.join(failed)}")
+            sys.exit(1)
@@ -2,18 +2,20 @@ from pymongo import MongoClient
 import json  # important ici
 
 def extract_tables_from_reports(mongo_uri="mongodb://localhost:27017/", db_name="rag_db",
-                                 input_collection="knowledge", output_collection="tables"):
+                                 input_collection="knowledge", output_collection="tables",
+                                 rapports=None):
     client = MongoClient(mongo_uri)
     db = client[db_name]
     knowledge = db[input_collection]
     tables = db[output_collection]
 
-    # Nettoyer l'ancienne collection de tableaux
-    tables.delete_many({})
+    # Nettoyer les anciens tableaux (tous, ou seulement ceux des rapports donnés)
+    query = {} if rapports is None else {"rapport": {"$in": list(rapports)}}
+    tables.delete_many(query)
 
     table_data = []
 
-    for doc in knowledge.find():  #  Fix ici
+    for doc in knowledge.find(query):  #  Fix ici
         rapport = doc.get("rapport", "unknown")
         for entry in doc.get("contenu", []):
             if entry.get("type") == "table":
@@ -0,0 +1,315 @@
+"""
+Détection des changements du dossier pdfs et daemon d'ingestion
+(python main.py --watch). Ce module n'ouvre aucune connexion et ne
+charge aucun modèle : le pipeline lui est passé sous forme de fonction.
+"""
+import os
+import sys
+import json
+import hashlib
+import time
+import threading
+import itertools
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# === Détection des changements ===
+# blake2b est nettement plus rapide que md5 sur les machines 64 bits
+HASH_ALGO = "blake2b"
+HASH_WORKERS = 4
+
+# === Mode daemon ===
+DAEMON_HOST = "127.0.0.1"
+DAEMON_PORT = int(os.getenv("INGEST_DAEMON_PORT", "5055"))
+DEBOUNCE_SECONDS = 5.0
+POLL_INTERVAL = 2.0
+MAX_JOBS_HISTORY = 50
+# Les lectures (opened, closed_no_write) ne déclenchent pas d'ingestion
+WATCHED_EVENT_TYPES = {"created", "modified", "moved", "deleted", "closed"}
+
+
+def compute_file_hash(path, algo=HASH_ALGO):
+    h = hashlib.new(algo)
+    with open(path, "rb") as f:
+        while chunk := f.read(1 << 20):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+def file_signature(path):
+    st = os.stat(path)
+    return [st.st_size, st.st_mtime_ns, st.st_ino]
+
+
+def load_stat_cache(path):
+    try:
+        with open(path, "r", encoding="utf-8") as f:
+            return json.load(f)
+    except (OSError, json.JSONDecodeError):
+        return {}
+
+
+def save_stat_cache(path, cache):
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        json.dump(cache, f)
+    os.replace(tmp_path, path)
+
+
+def compute_hashes(pdf_dir, pdf_files, stat_cache):
+    """
+    Retourne {nom: hash} pour les PDF donnés.
+    Seuls les fichiers dont (taille, mtime, inode) a changé sont relus,
+    et ils sont hachés en parallèle (hashlib libère le GIL).
+    """
+    hashes = {}
+    to_hash = {}
+    for name in pdf_files:
+        path = os.path.join(pdf_dir, name)
+        signature = file_signature(path)
+        cached = stat_cache.get(name)
+        if cached and cached.get("stat") == signature and cached.get("algo") == HASH_ALGO:
+            hashes[name] = cached["hash"]
+        else:
+            to_hash[name] = (path, signature)
+
+    if to_hash:
+        with ThreadPoolExecutor(max_workers=HASH_WORKERS) as pool:
+            results = pool.map(compute_file_hash, [path for path, _ in to_hash.values()])
+            for (name, (_, signature)), file_hash in zip(to_hash.items(), results):
+                hashes[name] = file_hash
+                stat_cache[name] = {"stat": signature, "algo": HASH_ALGO, "hash": file_hash}
+
+    # Oublier les fichiers supprimés du dossier
+    for name in list(stat_cache):
+        if name not in hashes:
+            del stat_cache[name]
+    return hashes
+
+
+def hash_matches_legacy_md5(path, stored_hash):
+    # Les anciens documents ont été indexés avec md5 (32 caractères hexa)
+    return bool(stored_hash) and len(stored_hash) == 32 and compute_file_hash(path, "md5") == stored_hash
+
+
+class IngestDaemon:
+    """
+    Regroupe les changements du dossier pdfs en jobs d'ingestion.
+    Les événements arrivant pendant DEBOUNCE_SECONDS rejoignent le même job,
+    et un seul job tourne à la fois : une rafale de téléversements
+    ne déclenche donc qu'une seule exécution du pipeline.
+    """
+
+    def __init__(self, run_job, debounce=DEBOUNCE_SECONDS):
+        # run_job(changed_files) -> {fichier: erreur} ; changed_files=None pour tout le dossier
+        self.run_job = run_job
+        self.debounce = debounce
+        self.cond = threading.Condition()
+        self.jobs = OrderedDict()
+        self.job_ids = itertools.count(1)
+        self.pending = None
+        self.running = None
+        self.last_event = 0.0
+
+    def notify(self, filename, source="watch"):
+        """Signale un changement et retourne l'id du job qui le traitera."""
+        with self.cond:
+            if self.pending is None:
+                job_id = next(self.job_ids)
+                self.pending = {
+                    "id": job_id,
+                    "status": "pending",
+                    "files": [],
+                    "full_scan": False,
+                    "sources": [],
+                    "created": time.time(),
+                    "started": None,
+                    "finished": None,
+                    "error": None,
+                }
+                self.jobs[job_id] = self.pending
+                while len(self.jobs) > MAX_JOBS_HISTORY:
+                    self.jobs.popitem(last=False)
+            if not filename:
+                self.pending["full_scan"] = True
+            elif filename not in self.pending["files"]:
+                self.pending["files"].append(filename)
+            if source not in self.pending["sources"]:
+                self.pending["sources"].append(source)
+            self.last_event = time.monotonic()
+            self.cond.notify_all()
+            return self.pending["id"]
+
+    def status(self):
+        with self.cond:
+            return {
+                "queue_depth": 1 if self.pending else 0,
+                "pending_files": list(self.pending["files"]) if self.pending else [],
+                "running": dict(self.running) if self.running else None,
+                "jobs": [dict(job) for job in reversed(self.jobs.values())],
+            }
+
+    def job(self, job_id):
+        with self.cond:
+            job = self.jobs.get(job_id)
+            return dict(job) if job else None
+
+    def next_job(self):
+        """Attend la fin de la fenêtre de regroupement et passe le job en cours."""
+        with self.cond:
+            while True:
+                while self.pending is None:
+                    self.cond.wait()
+                remaining = self.last_event + self.debounce - time.monotonic()
+                if remaining <= 0:
+                    break
+                self.cond.wait(remaining)
+            job, self.pending = self.pending, None
+            job["status"] = "running"
+            job["started"] = time.time()
+            self.running = job
+            return job
+
+    def execute(self, job):
+        print(f"Job {job['id']} : ingestion de {len(job['files'])} changement(s)", file=sys.stderr)
+        # Un job de démarrage ou sans fichier précis reprend tout le dossier
+        changed_files = None if job["full_scan"] else set(job["files"])
+        try:
+            failed = self.run_job(changed_files)
+            if failed:
+                # Les autres fichiers du job sont bien indexés, mais le job n'est pas un succès
+                status = "error"
+                error = "Échec pour : " + "; ".join(f"{name} ({e})" for name, e in failed.items())
+            else:
+                status, error = "done", None
+        except Exception as e:
+            print(f"Job {job['id']} : erreur : {e}", file=sys.stderr)
+            status, error = "error", str(e)
+
+        with self.cond:
+            job["status"] = status
+            job["error"] = error
+            job["finished"] = time.time()
+            self.running = None
+
+    def run_worker(self):
+        while True:
+            self.execute(self.next_job())
+
+
+def pdf_snapshot(pdf_dir):
+    return {
+        entry.name: file_signature(entry.path)
+        for entry in os.scandir(pdf_dir)
+        if entry.is_file() and entry.name.endswith(".pdf")
+    }
+
+
+def poll_pdf_dir(daemon, pdf_dir, interval=POLL_INTERVAL):
+    previous = None
+    while previous is None:
+        try:
+            previous = pdf_snapshot(pdf_dir)
+        except OSError as e:
+            print(f"Polling : lecture du dossier impossible : {e}", file=sys.stderr)
+            time.sleep(interval)
+    while True:
+        time.sleep(interval)
+        try:
+            current = pdf_snapshot(pdf_dir)
+        except OSError as e:
+            print(f"Polling : lecture du dossier impossible : {e}", file=sys.stderr)
+            continue
+        for name in set(previous) | set(current):
+            if previous.get(name) != current.get(name):
+                daemon.notify(name, source="poll")
+        previous = current
+
+
+def start_watcher(daemon, pdf_dir):
+    """Utilise inotify via watchdog si disponible, sinon un polling par stat."""
+    try:
+        from watchdog.observers import Observer
+        from watchdog.events import FileSystemEventHandler
+    except ImportError:
+        Observer = None
+
+    if Observer is not None:
+        class PdfEventHandler(FileSystemEventHandler):
+            def on_any_event(self, event):
+                if event.is_directory or event.event_type not in WATCHED_EVENT_TYPES:
+                    return
+                for path in (event.src_path, getattr(event, "dest_path", "")):
+                    if path and path.endswith(".pdf"):
+                        daemon.notify(os.path.basename(path), source="inotify")
+
+        try:
+            observer = Observer()
+            observer.schedule(PdfEventHandler(), pdf_dir, recursive=False)
+            observer.daemon = True
+            observer.start()
+            print("Surveillance du dossier 'pdfs' via inotify", file=sys.stderr)
+            return
+        except OSError as e:
+            print(f"inotify indisponible ({e}), bascule en polling", file=sys.stderr)
+
+    threading.Thread(target=poll_pdf_dir, args=(daemon, pdf_dir), daemon=True).start()
+    print(f"Surveillance du dossier 'pdfs' par polling ({POLL_INTERVAL}s)", file=sys.stderr)
+
+
+def make_status_handler(daemon):
+    class StatusHandler(BaseHTTPRequestHandler):
+        def send_json(self, payload, code=200):
+            body = json.dumps(payload, ensure_ascii=False).encode("utf-8")
+            self.send_response(code)
+            self.send_header("Content-Type", "application/json; charset=utf-8")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def do_GET(self):
+            if self.path == "/status":
+                return self.send_json(daemon.status())
+            if self.path.startswith("/jobs/"):
+                try:
+                    job = daemon.job(int(self.path[len("/jobs/"):]))
+                except ValueError:
+                    job = None
+                if job is None:
+                    return self.send_json({"error": "Job introuvable"}, 404)
+                return self.send_json(job)
+            self.send_json({"error": "Route inconnue"}, 404)
+
+        def do_POST(self):
+            if self.path != "/ingest":
+                return self.send_json({"error": "Route inconnue"}, 404)
+            length = int(self.headers.get("Content-Length", 0) or 0)
+            try:
+                payload = json.loads(self.rfile.read(length) or b"{}")
+            except json.JSONDecodeError:
+                payload = {}
+            job_id = daemon.notify(payload.get("file", ""), source="api")
+            self.send_json({"job_id": job_id}, 202)
+
+        def log_message(self, format, *args):
+            pass
+
+    return StatusHandler
+
+
+def run_daemon(pdf_dir, run_job):
+    print("Démarrage du daemon d'ingestion...", file=sys.stderr)
+    daemon = IngestDaemon(run_job)
+    # Rattrapage des changements survenus pendant l'arrêt du daemon
+    daemon.notify("", source="startup")
+    threading.Thread(target=daemon.run_worker, daemon=True).start()
+    start_watcher(daemon, pdf_dir)
+
+    server = ThreadingHTTPServer((DAEMON_HOST, DAEMON_PORT), make_status_handler(daemon))
+    print(f"Statut disponible sur http://{DAEMON_HOST}:{DAEMON_PORT}/status", file=sys.stderr)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        print("Arrêt du daemon d'ingestion.", file=sys.stderr)
+        server.server_close()
@@ -1,19 +1,17 @@
+import time
+_IMPORT_START = time.perf_counter()
+
 import sys
 import json
 import os
-import requests
 import io
 import re
 import urllib.parse
-import time
-from sentence_transformers import SentenceTransformer, CrossEncoder  # Ajout du reranker
-from pymongo import MongoClient
-from qdrant_client import QdrantClient
-from qdrant_client.http.models import SearchParams
-import os
+import random
+from datetime import datetime, timezone
 from dotenv import load_dotenv
-
-sys.stdout = io.TextIOWrapper(sys.stdout.buffer, encoding='utf-8')
+# sentence_transformers (torch), numpy, pymongo, qdrant_client et requests sont importés
+# à la première utilisation pour que les erreurs d'argument restent instantanées
 
 # === Config Qdrant Cloud ===
 
@@ -29,54 +27,250 @@ GROQ_API_KEY = os.getenv("GROQ_API_KEY")
 GROQ_MODEL = os.getenv("GROQ_MODEL")
 
 
-# === Connexions ===
-model = SentenceTransformer("all-MiniLM-L6-v2")
-reranker = CrossEncoder('cross-encoder/ms-marco-MiniLM-L-6-v2')
+# === Artefacts locaux (générés par --warmup) ===
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+MODELS_DIR = os.path.join(BASE_DIR, "modele_rag", "models")
+SNAPSHOT_PATH = os.path.join(BASE_DIR, "modele_rag", "query_snapshot.json")
+ENCODER_NAME = "all-MiniLM-L6-v2"
+RERANKER_NAME = "cross-encoder/ms-marco-MiniLM-L-6-v2"
+
+# Temps mesurés au démarrage, affichés par --warmup et --benchmark
+timings = {}
+
+def local_model_path(name):
+    return os.path.join(MODELS_DIR, name.replace("/", "__"))
+
+def models_cached():
+    return all(os.path.isdir(local_model_path(name)) for name in (ENCODER_NAME, RERANKER_NAME))
+
+# --warmup doit pouvoir compléter le cache depuis le hub
+_offline_allowed = True
+
+def load_local_or_hub(class_name, name, timing_key):
+    """
+    Charge le modèle (tokenizer inclus) depuis le cache local sérialisé par
+    --warmup, sans aucun appel au hub. Sans cache, on retombe sur le hub.
+    """
+    path = local_model_path(name)
+    local = os.path.isdir(path)
+    if _offline_allowed and models_cached():
+        # Seulement si les deux modèles sont en cache, sinon le second ne
+        # pourrait plus être téléchargé. À faire avant l'import :
+        # huggingface_hub lit ces variables une seule fois.
+        os.environ.setdefault("HF_HUB_OFFLINE", "1")
+        os.environ.setdefault("TRANSFORMERS_OFFLINE", "1")
+    start = time.perf_counter()
+    import sentence_transformers
+    # Seul le premier import coûte (torch, transformers) ; les suivants sont en cache
+    timings.setdefault("heavy_import_s", round(time.perf_counter() - start, 3))
+    cls = getattr(sentence_transformers, class_name)
+    start = time.perf_counter()
+    loaded = cls(path if local else name)
+    timings[timing_key] = round(time.perf_counter() - start, 3)
+    return loaded
+
+_model = None
+_reranker = None
+_qdrant_client = None
+_db = None
+_table_index = None
+
+def get_model():
+    global _model
+    if _model is None:
+        _model = load_local_or_hub("SentenceTransformer", ENCODER_NAME, "encoder_load_s")
+    return _model
+
+def get_reranker():
+    global _reranker
+    if _reranker is None:
+        _reranker = load_local_or_hub("CrossEncoder", RERANKER_NAME, "reranker_load_s")
+    return _reranker
+
+def get_qdrant():
+    global _qdrant_client
+    if _qdrant_client is None:
+        from qdrant_client import QdrantClient
+        _qdrant_client = QdrantClient(url=QDRANT_URL, api_key=QDRANT_API_KEY)
+    return _qdrant_client
 
-qdrant_client = QdrantClient(url=QDRANT_URL, api_key=QDRANT_API_KEY)
-client = MongoClient("mongodb://localhost:27017/")
-db = client["rag_db"]
-tables_col = db["tables"]
-all_tables = list(tables_col.find({}))
+def get_db():
+    global _db
+    if _db is None:
+        from pymongo import MongoClient
+        _db = MongoClient("mongodb://localhost:27017/")["rag_db"]
+    return _db
 
-def search_chunks(question, k=50):
-    vector = model.encode(question).tolist()
-    hits = qdrant_client.search(
+def snapshot_from_db():
+    tables = list(get_db()["tables"].find({}, {"_id": 0}))
+    return {
+        "created": time.time(),
+        "tables": tables,
+        "table_texts": [
+            " ".join(t["header"] + [cell for row in t["rows"] for cell in row]).lower()
+            for t in tables
+        ],
+    }
+
+def build_snapshot():
+    """
+    Écrit le snapshot des tableaux (fichier temporaire puis renommage).
+    Appelé uniquement par --warmup et par main.py après l'extraction des
+    tableaux : une requête ne l'écrit jamais, pour ne pas figer un état
+    intermédiaire de la collection pendant une réingestion.
+    """
+    snapshot = snapshot_from_db()
+    tmp_path = f"{SNAPSHOT_PATH}.{os.getpid()}.tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        json.dump(snapshot, f, ensure_ascii=False)
+    os.replace(tmp_path, SNAPSHOT_PATH)
+    return snapshot
+
+def load_table_index():
+    """
+    Charge l'index des tableaux depuis le snapshot (régénéré par main.py à
+    chaque réingestion), ou directement depuis MongoDB s'il manque.
+    """
+    try:
+        with open(SNAPSHOT_PATH, "r", encoding="utf-8") as f:
+            snapshot = json.load(f)
+    except (OSError, json.JSONDecodeError):
+        snapshot = snapshot_from_db()
+    groups = {}
+    for t in snapshot["tables"]:
+        groups.setdefault((t["rapport"], tuple(t["header"])), []).append(t)
+    snapshot["groups"] = groups
+    return snapshot
+
+def get_table_index():
+    global _table_index
+    if _table_index is None:
+        start = time.perf_counter()
+        _table_index = load_table_index()
+        timings["snapshot_load_s"] = round(time.perf_counter() - start, 3)
+    return _table_index
+
+# === Sessions de conversation ===
+SESSION_TTL_SECONDS = 2 * 3600
+SESSION_BUDGET_BYTES = 20 * 1024 * 1024
+SESSION_BUDGET_CHECK_EVERY = 20
+MAX_SESSION_TURNS = 5
+CACHED_CANDIDATES = 20
+FOLLOWUP_K = 15
+FOLLOWUP_MAX_WORDS = 8
+FOLLOWUP_SIMILARITY = 0.6
+# Connecteurs d'une question de suivi : la même liste sert à la détecter et à les retirer
+FOLLOWUP_CONNECTEURS = ("et", "quid", "qu'en est-il", "qu’en est-il", "idem", "même chose", "dans ce cas")
+CONNECTEUR_PATTERN = re.compile(
+    r"^(?:" + "|".join(re.escape(c) for c in FOLLOWUP_CONNECTEURS) + r")\b[\s,]*(?:pour\b\s*)?",
+    re.IGNORECASE
+)
+MAX_REWRITE_CHARS = 300
+# Mots qui montrent qu'une question courte est complète (interrogatif ou verbe)
+MOTS_QUESTION_COMPLETE = {
+    "quel", "quelle", "quels", "quelles", "combien", "comment", "pourquoi", "où", "quand",
+    "qui", "que", "quoi", "est", "sont", "était", "a", "ont", "y", "peut", "peux", "pouvez",
+    "donne", "donnez", "explique", "expliquez", "décris", "décrivez", "liste", "listez",
+    "compare", "comparez", "résume", "résumez", "montre", "montrez", "existe",
+}
+# Mots ignorés pour savoir si une question de suivi apporte une précision en plus du sujet
+MOTS_VIDES = {
+    "le", "la", "les", "l", "un", "une", "des", "du", "de", "d", "à", "au", "aux", "en",
+    "pour", "ou", "sur", "dans", "par", "avec", "ce", "cette", "ces", "et",
+}
+# Suite de noms propres (ex : "Tanger Med", "Nador") ou année
+ENTITE_PATTERN = re.compile(r"[A-ZÀ-Ý][\w’'-]*(?:\s+[A-ZÀ-Ý][\w’'-]*)*|\b(?:19|20)\d{2}\b")
+
+def cosine(a, b):
+    import numpy as np
+    a = np.asarray(a, dtype=np.float32)
+    b = np.asarray(b, dtype=np.float32)
+    denom = np.linalg.norm(a) * np.linalg.norm(b)
+    return float(a @ b / denom) if denom else 0.0
+
+def vector_search(vector, k):
+    from qdrant_client.http.models import SearchParams
+    hits = get_qdrant().search(
         collection_name=COLLECTION_NAME,
-        query_vector=vector,
+        query_vector=list(vector),
         limit=k,
         with_payload=True,
         search_params=SearchParams(hnsw_ef=128)
     )
-    candidates = [hit.payload for hit in hits]
-    texts = [(question, c['content']) for c in candidates if 'content' in c]
-    scores = reranker.predict(texts)
+    return [{"id": hit.id, "payload": hit.payload} for hit in hits if 'content' in hit.payload]
+
+def attach_vectors(candidates):
+    # Seuls les candidats mis en cache ont besoin de leur vecteur
+    missing = [c["id"] for c in candidates if "vector" not in c]
+    if missing:
+        points = get_qdrant().retrieve(
+            collection_name=COLLECTION_NAME,
+            ids=missing,
+            with_payload=False,
+            with_vectors=True
+        )
+        vectors = {p.id: [float(x) for x in p.vector] for p in points}
+        for c in candidates:
+            if "vector" not in c and c["id"] in vectors:
+                c["vector"] = vectors[c["id"]]
+    return [c for c in candidates if "vector" in c]
+
+def rerank_candidates(question, candidates):
+    if not candidates:
+        return []
+    texts = [(question, c["payload"]["content"]) for c in candidates]
+    scores = get_reranker().predict(texts)
     reranked = sorted(zip(scores, candidates), key=lambda x: x[0], reverse=True)
-    return [c for _, c in reranked[:10]]
+    return [c for _, c in reranked]
+
+def search_chunks(question, k=50, vector=None):
+    if vector is None:
+        vector = get_model().encode(question)
+    return rerank_candidates(question, vector_search(vector, k))
+
+def search_chunks_followup(question, vector, session, k=FOLLOWUP_K):
+    """
+    Recherche incrémentale pour une question de suivi : les candidats déjà
+    classés au tour précédent sont re-scorés par similarité cosinus avec la
+    nouvelle requête, puis fusionnés avec une recherche Qdrant réduite avant
+    le reranking.
+    """
+    cached = sorted(
+        session.get("candidates", []),
+        key=lambda c: cosine(vector, c["vector"]),
+        reverse=True
+    )[:CACHED_CANDIDATES // 2]
+    merged = []
+    seen = set()
+    for candidate in vector_search(vector, k) + cached:
+        if candidate["id"] in seen:
+            continue
+        seen.add(candidate["id"])
+        merged.append(candidate)
+    return rerank_candidates(question, merged)
 
 def search_tables(question, limit=5):
     keywords = set(question.lower().split())
+    index = get_table_index()
     table_scores = []
-    for table in all_tables:
-        text = " ".join(table["header"] + [cell for row in table["rows"] for cell in row]).lower()
+    for table, text in zip(index["tables"], index["table_texts"]):
         score = sum(1 for word in keywords if word in text)
         if score > 0:
             table_scores.append((score, table))
     table_scores.sort(key=lambda x: x[0], reverse=True)
+    return merge_tables([table for _, table in table_scores[:limit]])
+
+def merge_tables(tables):
     merged_results = []
     seen = set()
-    for _, table in table_scores[:limit]:
+    for table in tables:
         key = (table["rapport"], tuple(table["header"]))
         if key in seen:
             continue
         seen.add(key)
         full_rows = []
-        for t in all_tables:
-            if (
-                t["rapport"] == table["rapport"]
-                and t["header"] == table["header"]
-                and abs(t["page"] - table["page"]) <= 2
-            ):
+        for t in get_table_index()["groups"].get(key, []):
+            if abs(t["page"] - table["page"]) <= 2:
                 full_rows.extend(t["rows"])
         merged_results.append({
             "rapport": table["rapport"],
@@ -86,6 +280,113 @@ def search_tables(question, limit=5):
         })
     return merged_results
 
+def search_tables_followup(question, session, limit=5):
+    # Les tableaux du tour précédent restent candidats pour la question de suivi
+    previous = [
+        t for key in session.get("table_keys", [])
+        for t in get_table_index()["groups"].get((key["rapport"], tuple(key["header"])), [])
+        if t["page"] == key["page"]
+    ]
+    return merge_tables(search_tables(question, limit) + previous)[:limit]
+
+def load_session(conversation_id):
+    if not conversation_id:
+        return None
+    return get_db()["sessions"].find_one({"_id": conversation_id})
+
+def semble_incomplete(question):
+    mots = re.findall(r"[\w’'-]+", question.lower())
+    return len(mots) <= FOLLOWUP_MAX_WORDS and not any(
+        m in MOTS_QUESTION_COMPLETE or m.split("'")[0] in MOTS_QUESTION_COMPLETE for m in mots
+    )
+
+def est_question_de_suivi(question, vector, session):
+    if not session or not session.get("turns"):
+        return False
+    if CONNECTEUR_PATTERN.match(question.strip()):
+        return True
+    return (
+        semble_incomplete(question)
+        and cosine(vector, session["turns"][-1]["embedding"]) >= FOLLOWUP_SIMILARITY
+    )
+
+def question_racine(session):
+    # Dernière question autonome de la conversation (les anciennes sessions n'ont pas de racine)
+    return session.get("root") or session["turns"][-1]["rewritten"]
+
+def reformuler_question(question, session):
+    """
+    Rend autonome une question de suivi à partir de la dernière question
+    autonome de la conversation, en remplaçant son sujet (noms propres,
+    année) par celui de la question de suivi. Si la suite apporte d'autres
+    précisions, elle est ajoutée à la question obtenue.
+    Ex : "Quel est le trafic du port de Tanger ?" + "et pour le port de Nador ?"
+    -> "Quel est le trafic du port de Nador ?"
+    """
+    racine = question_racine(session).strip()
+    suite = CONNECTEUR_PATTERN.sub("", question.strip()).strip() or question.strip()
+
+    # Un article en début de phrase ("Le port de Nador ?") n'est pas un nom propre
+    entites = [e for e in ENTITE_PATTERN.findall(suite) if e.lower() not in MOTS_VIDES]
+
+    reformulee = racine
+    for nouvelle in entites:
+        est_annee = nouvelle.isdigit()
+        # Le premier mot de la racine porte une majuscule de phrase, pas un nom propre
+        anciennes = [
+            m for m in ENTITE_PATTERN.finditer(reformulee)
+            if m.start() > 0 and m.group().isdigit() == est_annee
+        ]
+        if anciennes:
+            m = anciennes[-1]
+            reformulee = reformulee[:m.start()] + nouvelle + reformulee[m.end():]
+
+    mots_connus = set(re.findall(r"\w+", racine.lower())) | MOTS_VIDES
+    mots_connus |= {m for e in entites for m in re.findall(r"\w+", e.lower())}
+    precisions = [m for m in re.findall(r"\w+", suite.lower()) if m not in mots_connus]
+    if reformulee == racine or precisions:
+        # Aucun sujet à remplacer, ou précision en plus du sujet : on l'ajoute
+        reformulee = f"{reformulee.rstrip(' ?')} — {suite}"
+    return reformulee[:MAX_REWRITE_CHARS]
+
+def ensure_sessions_index():
+    # Appelé par --warmup et main.py, pas à chaque requête
+    get_db()["sessions"].create_index("last_used", expireAfterSeconds=SESSION_TTL_SECONDS)
+
+def evict_sessions():
+    """
+    L'expiration des sessions inactives est assurée par l'index TTL de
+    MongoDB sur last_used. Ici on ne fait que respecter le budget mémoire,
+    à partir de la taille de la collection (sans la parcourir).
+    Chaque requête étant un processus distinct, la vérification n'a lieu
+    qu'en moyenne une sauvegarde sur SESSION_BUDGET_CHECK_EVERY.
+    """
+    if random.random() >= 1 / SESSION_BUDGET_CHECK_EVERY:
+        return
+    sessions = get_db()["sessions"]
+    stats = next(sessions.aggregate([{"$collStats": {"storageStats": {}}}]), {}).get("storageStats", {})
+    size, count = stats.get("size", 0), stats.get("count", 0)
+    if size <= SESSION_BUDGET_BYTES or not count:
+        return
+    # Supprimer les plus anciennes au prorata du dépassement
+    excess = int(count * (1 - SESSION_BUDGET_BYTES / size)) + 1
+    oldest = [doc["_id"] for doc in sessions.find({}, {"_id": 1}).sort("last_used", 1).limit(excess)]
+    sessions.delete_many({"_id": {"$in": oldest}})
+
+def save_session(conversation_id, session, turn, root, ranked, tables):
+    turns = (session.get("turns", []) if session else []) + [turn]
+    doc = {
+        "root": root,
+        "turns": turns[-MAX_SESSION_TURNS:],
+        "candidates": attach_vectors(ranked[:CACHED_CANDIDATES]),
+        "table_keys": [
+            {"rapport": t["rapport"], "header": t["header"], "page": t["page"]} for t in tables
+        ],
+        "last_used": datetime.now(timezone.utc),
+    }
+    get_db()["sessions"].replace_one({"_id": conversation_id}, doc, upsert=True)
+    evict_sessions()
+
 def format_markdown_table(header, rows):
     md = "| " + " | ".join(header) + " |\n"
     md += "| " + " | ".join(["---"] * len(header)) + " |\n"
@@ -97,7 +398,7 @@ def question_est_comparative(question):
     mots = ["compar", "différence", "différencier", "vs", "contre", "meilleur", "par rapport", "différences"]
     return any(mot in question.lower() for mot in mots)
 
-def build_prompt(text_chunks, table_matches, question, history):
+def build_prompt(text_chunks, table_matches, question, history, standalone_question=None):
     grouped_contexts = {}
     for chunk in text_chunks:
         rapport = chunk.get("rapport", "Rapport inconnu")
@@ -132,6 +433,10 @@ def build_prompt(text_chunks, table_matches, question, history):
         "Tu es un expert assistant en analyse de documents techniques extraits de PDF.\n\n"
         "---\n"
         f"**Question posée :**\n{question}\n"
+    )
+    if standalone_question and standalone_question != question:
+        prompt += f"**Question reformulée avec le contexte :**\n{standalone_question}\n"
+    prompt += (
         "---\n"
         "**Consignes strictes pour générer ta réponse :**\n"
         "- Réponds de manière complète, rigoureuse et bien structurée (utilise des paragraphes, titres, listes ou tableaux si nécessaire).\n"
@@ -157,6 +462,7 @@ def build_prompt(text_chunks, table_matches, question, history):
     return prompt
 
 def call_groq(prompt, retries=3, backoff=2):
+    import requests
     url = "https://api.groq.com/openai/v1/chat/completions"
     headers = {
         "Authorization": f"Bearer {GROQ_API_KEY}",
@@ -193,27 +499,101 @@ def ajouter_section_rapports_utilises(answer_text, chunks, tables):
     section = "\n\n---\n**Rapports utilisés :**\n" + "\n".join(f"- {l}" for l in liens)
     return answer_text.strip() + section
 
+def retrieve(question, conversation_id=""):
+    session = load_session(conversation_id)
+    vector = get_model().encode(question)
+    if est_question_de_suivi(question, vector, session):
+        standalone = reformuler_question(question, session)
+        root = question_racine(session)
+        vector = get_model().encode(standalone)
+        ranked = search_chunks_followup(standalone, vector, session)
+        tables = search_tables_followup(standalone, session)
+    else:
+        standalone = root = question
+        ranked = search_chunks(question, vector=vector)
+        tables = search_tables(question)
+    if conversation_id:
+        turn = {"question": question, "rewritten": standalone, "embedding": vector.tolist()}
+        save_session(conversation_id, session, turn, root, ranked, tables)
+    return standalone, [c["payload"] for c in ranked[:10]], tables
+
+def warmup():
+    """
+    Sérialise les modèles (et leurs tokenizers) dans modele_rag/models et
+    régénère le snapshot des tableaux, pour que les requêtes suivantes
+    démarrent sans appel au hub ni lecture complète de la collection.
+    """
+    global _offline_allowed
+    _offline_allowed = False
+    start = time.perf_counter()
+    os.makedirs(MODELS_DIR, exist_ok=True)
+    for name, loader in ((ENCODER_NAME, get_model), (RERANKER_NAME, get_reranker)):
+        path = local_model_path(name)
+        loaded = loader()
+        if not os.path.isdir(path):
+            # Écriture dans un dossier temporaire : un warmup interrompu ne
+            # laisse pas de modèle incomplet dans le cache
+            tmp_path = f"{path}.{os.getpid()}.tmp"
+            loaded.save(tmp_path)
+            os.replace(tmp_path, path)
+    snapshot = build_snapshot()
+    ensure_sessions_index()
+    get_model().encode("warmup")
+    timings["total_s"] = round(time.perf_counter() - start, 3)
+    print(json.dumps({
+        "warmup": "ok",
+        "tables": len(snapshot["tables"]),
+        "timings": timings
+    }, ensure_ascii=False))
+
+def benchmark(question):
+    # Mesure le démarrage et la recherche, sans appel à Groq
+    start = time.perf_counter()
+    get_table_index()
+    get_model()
+    get_reranker()
+    timings["startup_s"] = round(time.perf_counter() - start, 3)
+    start = time.perf_counter()
+    _, chunks, tables = retrieve(question)
+    timings["retrieval_s"] = round(time.perf_counter() - start, 3)
+    print(json.dumps({
+        "question": question,
+        "chunks": len(chunks),
+        "tables": len(tables),
+        "timings": timings
+    }, ensure_ascii=False))
+
+timings["import_s"] = round(time.perf_counter() - _IMPORT_START, 3)
+
 def main():
-    if len(sys.argv) < 2:
+    if len(sys.argv) > 1 and sys.argv[1] == "--warmup":
+        warmup()
+        return
+    if len(sys.argv) > 1 and sys.argv[1] == "--benchmark":
+        benchmark(sys.argv[2] if len(sys.argv) > 2 else "Quel est le trafic portuaire ?")
+        return
+    if len(sys.argv) < 2 or not sys.argv[1].strip():
         print(json.dumps({"error": "Aucune question fournie"}, ensure_ascii=False))
         sys.exit(0)
 
     question = sys.argv[1].strip()
     history_json = sys.argv[2] if len(sys.argv) > 2 else "[]"
+    conversation_id = sys.argv[3] if len(sys.argv) > 3 else ""
     try:
         history = json.loads(history_json)
     except:
         history = []
     try:
-        chunks = search_chunks(question)
-        tables = search_tables(question)
-        prompt = build_prompt(chunks, tables, question, history)
+        standalone, chunks, tables = retrieve(question, conversation_id)
+        prompt = build_prompt(chunks, tables, question, history, standalone)
         answer = call_groq(prompt)
         answer = ajouter_section_rapports_utilises(answer, chunks, tables)
+        print(f"Temps de démarrage : {json.dumps(timings)}", file=sys.stderr)
         print(json.dumps({"answer": answer}, ensure_ascii=False))
     except Exception as e:
         print(json.dumps({"error": f"Erreur interne : {str(e)}"}, ensure_ascii=False))
         sys.exit(0)
 
 if __name__ == "__main__":
+    sys.stdout = io.TextIOWrapper(sys.stdout.buffer, encoding='utf-8')
     main()
\ No newline at end of file
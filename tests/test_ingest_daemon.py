@@ -0,0 +1,137 @@
+import hashlib
+
+from modele_rag import ingest_daemon
+
+
+def write_pdf(directory, name, content):
+    path = directory / name
+    path.write_bytes(content)
+    return path
+
+
+def count_hash_calls(monkeypatch):
+    calls = []
+    original = ingest_daemon.compute_file_hash
+
+    def counting(path, algo=ingest_daemon.HASH_ALGO):
+        calls.append(path)
+        return original(path, algo)
+
+    monkeypatch.setattr(ingest_daemon, "compute_file_hash", counting)
+    return calls
+
+
+def test_stat_cache_evite_de_rehacher_un_fichier_inchange(tmp_path, monkeypatch):
+    write_pdf(tmp_path, "a.pdf", b"contenu a")
+    cache = {}
+    first = ingest_daemon.compute_hashes(str(tmp_path), ["a.pdf"], cache)
+    assert first["a.pdf"] == hashlib.blake2b(b"contenu a").hexdigest()
+
+    calls = count_hash_calls(monkeypatch)
+    assert ingest_daemon.compute_hashes(str(tmp_path), ["a.pdf"], cache) == first
+    assert calls == []
+
+
+def test_stat_cache_rehache_un_fichier_modifie(tmp_path, monkeypatch):
+    write_pdf(tmp_path, "a.pdf", b"contenu a")
+    cache = {}
+    ingest_daemon.compute_hashes(str(tmp_path), ["a.pdf"], cache)
+
+    write_pdf(tmp_path, "a.pdf", b"nouveau contenu a")
+    calls = count_hash_calls(monkeypatch)
+    hashes = ingest_daemon.compute_hashes(str(tmp_path), ["a.pdf"], cache)
+    assert len(calls) == 1
+    assert hashes["a.pdf"] == hashlib.blake2b(b"nouveau contenu a").hexdigest()
+
+
+def test_stat_cache_oublie_les_fichiers_supprimes(tmp_path):
+    write_pdf(tmp_path, "a.pdf", b"a")
+    write_pdf(tmp_path, "b.pdf", b"b")
+    cache = {}
+    ingest_daemon.compute_hashes(str(tmp_path), ["a.pdf", "b.pdf"], cache)
+    ingest_daemon.compute_hashes(str(tmp_path), ["a.pdf"], cache)
+    assert set(cache) == {"a.pdf"}
+
+
+def test_stat_cache_survit_a_un_aller_retour_disque(tmp_path):
+    write_pdf(tmp_path, "a.pdf", b"a")
+    cache_path = str(tmp_path / "cache.json")
+    cache = {}
+    ingest_daemon.compute_hashes(str(tmp_path), ["a.pdf"], cache)
+    ingest_daemon.save_stat_cache(cache_path, cache)
+    assert ingest_daemon.load_stat_cache(cache_path) == cache
+    assert ingest_daemon.load_stat_cache(str(tmp_path / "absent.json")) == {}
+
+
+def test_migration_md5_reconnait_l_ancien_hash(tmp_path):
+    path = str(write_pdf(tmp_path, "a.pdf", b"contenu a"))
+    assert ingest_daemon.hash_matches_legacy_md5(path, hashlib.md5(b"contenu a").hexdigest())
+    assert not ingest_daemon.hash_matches_legacy_md5(path, hashlib.md5(b"autre").hexdigest())
+    assert not ingest_daemon.hash_matches_legacy_md5(path, "")
+    # Un hash blake2b (128 caractères) n'est jamais comparé en md5
+    assert not ingest_daemon.hash_matches_legacy_md5(path, hashlib.blake2b(b"contenu a").hexdigest())
+
+
+def test_rafale_de_notifications_regroupee_en_un_job():
+    daemon = ingest_daemon.IngestDaemon(lambda files: {}, debounce=0.01)
+    first = daemon.notify("a.pdf")
+    second = daemon.notify("b.pdf", source="api")
+    assert first == second
+    assert daemon.status()["queue_depth"] == 1
+
+    job = daemon.next_job()
+    assert job["files"] == ["a.pdf", "b.pdf"]
+    assert job["sources"] == ["watch", "api"]
+    assert daemon.status()["queue_depth"] == 0
+
+
+def test_notification_pendant_un_job_cree_un_second_job():
+    daemon = ingest_daemon.IngestDaemon(lambda files: {}, debounce=0.01)
+    daemon.notify("a.pdf")
+    running = daemon.next_job()
+    queued = daemon.notify("b.pdf")
+
+    status = daemon.status()
+    assert queued != running["id"]
+    assert status["running"]["id"] == running["id"]
+    assert status["pending_files"] == ["b.pdf"]
+
+
+def test_job_execute_avec_les_fichiers_modifies():
+    received = []
+    daemon = ingest_daemon.IngestDaemon(lambda files: received.append(files) or {}, debounce=0.01)
+    daemon.notify("a.pdf")
+    job = daemon.next_job()
+    daemon.execute(job)
+    assert received == [{"a.pdf"}]
+    assert daemon.job(job["id"])["status"] == "done"
+
+
+def test_job_sans_fichier_reprend_tout_le_dossier():
+    received = []
+    daemon = ingest_daemon.IngestDaemon(lambda files: received.append(files) or {}, debounce=0.01)
+    daemon.notify("", source="startup")
+    daemon.notify("a.pdf")
+    daemon.execute(daemon.next_job())
+    assert received == [None]
+
+
+def test_echec_d_un_fichier_marque_le_job_en_erreur():
+    daemon = ingest_daemon.IngestDaemon(lambda files: {"a.pdf": "PDF illisible"}, debounce=0.01)
+    daemon.notify("a.pdf")
+    job = daemon.next_job()
+    daemon.execute(job)
+    result = daemon.job(job["id"])
+    assert result["status"] == "error"
+    assert "a.pdf" in result["error"] and "PDF illisible" in result["error"]
+
+
+def test_exception_du_pipeline_marque_le_job_en_erreur():
+    def crash(files):
+        raise RuntimeError("Qdrant injoignable")
+
+    daemon = ingest_daemon.IngestDaemon(crash, debounce=0.01)
+    daemon.notify("a.pdf")
+    job = daemon.next_job()
+    daemon.execute(job)
+    assert daemon.job(job["id"])["error"] == "Qdrant injoignable"
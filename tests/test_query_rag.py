@@ -0,0 +1,104 @@
+import query_rag
+
+
+def make_session(root, embedding=(1.0, 0.0)):
+    return {"root": root, "turns": [{"rewritten": root, "embedding": list(embedding)}]}
+
+
+def test_sans_session_pas_de_suivi():
+    assert not query_rag.est_question_de_suivi("et pour Nador ?", [1.0, 0.0], None)
+
+
+def test_connecteur_en_tete_est_un_suivi():
+    session = make_session("Quel est le trafic du port de Tanger ?")
+    assert query_rag.est_question_de_suivi("et pour le port de Nador ?", [0.0, 1.0], session)
+
+
+def test_question_commencant_par_pour_est_autonome():
+    session = make_session("Quel est le trafic du port de Tanger ?")
+    question = "Pour quelles raisons le trafic a-t-il baissé en 2022 ?"
+    assert not query_rag.est_question_de_suivi(question, [1.0, 0.0], session)
+
+
+def test_question_courte_complete_est_autonome_malgre_similarite():
+    session = make_session("Quel est le trafic du port de Tanger ?")
+    assert not query_rag.est_question_de_suivi("Quel est le trafic à Nador ?", [1.0, 0.0], session)
+
+
+def test_question_incomplete_et_similaire_est_un_suivi():
+    session = make_session("Quel est le trafic du port de Tanger ?")
+    assert query_rag.est_question_de_suivi("le port de Nador ?", [1.0, 0.1], session)
+
+
+def test_question_incomplete_mais_eloignee_est_autonome():
+    session = make_session("Quel est le trafic du port de Tanger ?")
+    assert not query_rag.est_question_de_suivi("le port de Nador ?", [0.0, 1.0], session)
+
+
+def test_reformulation_remplace_le_sujet():
+    session = make_session("Quel est le trafic du port de Tanger ?")
+    assert (
+        query_rag.reformuler_question("et pour le port de Nador ?", session)
+        == "Quel est le trafic du port de Nador ?"
+    )
+
+
+def test_reformulation_ne_s_accumule_pas():
+    session = make_session("Quel est le trafic du port de Tanger Med en 2021 ?")
+    session["turns"].append({"rewritten": "Quel est le trafic du port de Nador en 2021 ?", "embedding": [1.0, 0.0]})
+    assert (
+        query_rag.reformuler_question("et pour Agadir ?", session)
+        == "Quel est le trafic du port de Agadir en 2021 ?"
+    )
+
+
+def test_reformulation_remplace_l_annee():
+    session = make_session("Quel est le trafic du port de Tanger en 2021 ?")
+    assert (
+        query_rag.reformuler_question("et en 2023 ?", session)
+        == "Quel est le trafic du port de Tanger en 2023 ?"
+    )
+
+
+def test_reformulation_sans_sujet_ajoute_la_precision_et_reste_bornee():
+    session = make_session("Quel est le trafic du port de Tanger ?" + " détail" * 100)
+    reformulee = query_rag.reformuler_question("et les conteneurs ?", session)
+    assert reformulee.endswith("les conteneurs ?") or len(reformulee) == query_rag.MAX_REWRITE_CHARS
+    assert len(reformulee) <= query_rag.MAX_REWRITE_CHARS
+
+
+def test_chaque_connecteur_marque_un_suivi_et_est_retire():
+    session = make_session("Quel est le trafic du port de Tanger en 2021 ?")
+    for connecteur in query_rag.FOLLOWUP_CONNECTEURS:
+        question = f"{connecteur.capitalize()} pour Nador ?"
+        assert query_rag.est_question_de_suivi(question, [0.0, 1.0], session), connecteur
+        assert (
+            query_rag.reformuler_question(question, session)
+            == "Quel est le trafic du port de Nador en 2021 ?"
+        ), connecteur
+
+
+def test_connecteur_capitalise_n_est_pas_pris_pour_un_lieu():
+    session = make_session("Quel est le trafic du port de Tanger en 2021 ?")
+    question = "Dans ce cas, quel est le tonnage ?"
+    assert query_rag.est_question_de_suivi(question, [0.0, 1.0], session)
+    reformulee = query_rag.reformuler_question(question, session)
+    assert "Dans" not in reformulee
+    assert "Tanger" in reformulee
+
+
+def test_mot_commencant_par_et_n_est_pas_un_connecteur():
+    session = make_session("Quel est le trafic du port de Tanger ?")
+    assert not query_rag.est_question_de_suivi("Etat des quais à Nador en détail ?", [0.0, 1.0], session)
+
+
+def test_reformulation_garde_les_precisions_en_plus_du_sujet():
+    session = make_session("Quel est le trafic du port de Tanger en 2021 ?")
+    reformulee = query_rag.reformuler_question("Et pour le tonnage des conteneurs à Nador ?", session)
+    assert reformulee == "Quel est le trafic du port de Nador en 2021 — le tonnage des conteneurs à Nador ?"
+    assert "Tanger" not in reformulee
+
+
+def test_article_en_tete_n_est_pas_un_sujet():
+    session = make_session("Quel est le trafic du port de Tanger ?")
+    assert query_rag.reformuler_question("Le port de Nador ?", session) == "Quel est le trafic du port de Nador ?"